@@ -8,6 +8,14 @@ from bot.bot import Bot
 from bot.non_blocking_file_handler import NonBlockingFileHandler
 
 
+try:
+    # Faster event loop, not available on Windows so fallback to default asyncio one
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
+
 root_logger = logging.getLogger()
 root_logger.setLevel(logging.INFO)
 
@@ -1,11 +1,11 @@
 import os
-import json
 import logging
 from asyncio import AbstractEventLoop
 from datetime import datetime, timezone
-from typing import Optional, List, Union
+from typing import Optional, List, Union, AsyncGenerator, Dict
 
 import aiohttp
+import orjson
 from dotenv import load_dotenv
 from discord import Member, User, Message
 
@@ -34,52 +34,111 @@ class ResponseCodeError(ValueError):
         return f"Status: {self.status} Response: {response}"
 
 
+def load_json(body: bytes) -> Optional[Union[dict, List[dict]]]:
+    """Deserialize response body, empty body (eg. 200 with no content) returns None."""
+    if not body:
+        return None
+    return orjson.loads(body)
+
+
+async def raise_for_status(response: aiohttp.ClientResponse) -> None:
+    """Raise ResponseCodeError for non-OK response if an exception should be raised."""
+    if response.status >= 400:
+        body = await response.read()
+        try:
+            response_json = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            raise ResponseCodeError(response=response, response_text=body.decode(errors="replace"))
+        else:
+            raise ResponseCodeError(response=response, response_json=response_json)
+
+
 class BaseAPIClient:
     def __init__(self, base_api_url: str, *, loop: Optional[AbstractEventLoop], **kwargs):
         self.base_api_url = base_api_url
-        self.session = aiohttp.ClientSession(loop=loop, **kwargs)
-
-    def _url_for(self, endpoint: str) -> str:
-        return f"{self.base_api_url}{endpoint}"
-
-    @classmethod
-    async def raise_for_status(cls, response: aiohttp.ClientResponse) -> None:
-        """Raise ResponseCodeError for non-OK response if an exception should be raised."""
-        if response.status >= 400:
-            try:
-                response_json = await response.json()
-                raise ResponseCodeError(response=response, response_json=response_json)
-            except aiohttp.ContentTypeError:
-                response_text = await response.text()
-                raise ResponseCodeError(response=response, response_text=response_text)
-
-    async def get(self, endpoint: str, **kwargs) -> Union[dict, List[dict]]:
-        async with self.session.get(self._url_for(endpoint), **kwargs) as resp:
-            await self.raise_for_status(resp)
-            return await resp.json()
+        # Keep connections (and their TLS sessions) alive between the periodic requests so we don't
+        # pay for a new handshake each time the pool goes idle.
+        connector = aiohttp.TCPConnector(
+            loop=loop,
+            limit=32,
+            limit_per_host=16,
+            keepalive_timeout=300,
+            ttl_dns_cache=600,
+            enable_cleanup_closed=True,
+            force_close=False
+        )
+        kwargs.setdefault("timeout", aiohttp.ClientTimeout(total=30))
+        self.session = aiohttp.ClientSession(loop=loop, connector=connector, **kwargs)
+        # Endpoint and params to (ETag, raw body) of its last response, only for GET requests made with conditional=True
+        self._etag_cache = {}
+
+    async def close(self):
+        await self.session.close()
+
+    @staticmethod
+    def _serialize_json(kwargs: dict) -> dict:
+        """Serialize `json` payload with orjson instead of letting aiohttp use stdlib json."""
+        if "json" in kwargs:
+            kwargs["data"] = orjson.dumps(kwargs.pop("json"))
+            headers = dict(kwargs.get("headers") or {})
+            headers["Content-Type"] = "application/json"
+            kwargs["headers"] = headers
+        return kwargs
+
+    async def get(self, endpoint: str, *, conditional: bool = False, **kwargs) -> Union[dict, List[dict]]:
+        """
+        :param conditional: send If-None-Match with the ETag of the last response for this endpoint and reuse
+                            its body on 304. Only meant for a few rarely changing endpoints since every
+                            endpoint used this way keeps its last response body in memory.
+        """
+        params = kwargs.get("params")
+        cache_key = (endpoint, frozenset(params.items()) if params else None)
+        cached = self._etag_cache.get(cache_key) if conditional else None
+        if cached is not None:
+            headers = dict(kwargs.get("headers") or {})
+            headers["If-None-Match"] = cached[0]
+            kwargs["headers"] = headers
+
+        async with self.session.get(self.base_api_url + endpoint, **self._serialize_json(kwargs)) as resp:
+            if resp.status == 304 and cached is not None:
+                # Parse again so each caller gets its own objects
+                return load_json(cached[1])
+
+            await raise_for_status(resp)
+            body = await resp.read()
+
+            etag = resp.headers.get("ETag")
+            if conditional and etag is not None:
+                self._etag_cache[cache_key] = (etag, body)
+            return load_json(body)
 
     async def patch(self, endpoint: str, **kwargs) -> dict:
-        async with self.session.patch(self._url_for(endpoint), **kwargs) as resp:
-            await self.raise_for_status(resp)
-            return await resp.json()
+        async with self.session.patch(self.base_api_url + endpoint, **self._serialize_json(kwargs)) as resp:
+            await raise_for_status(resp)
+            return load_json(await resp.read())
 
     async def post(self, endpoint: str, **kwargs) -> dict:
-        async with self.session.post(self._url_for(endpoint), **kwargs) as resp:
-            await self.raise_for_status(resp)
-            return await resp.json()
+        async with self.session.post(self.base_api_url + endpoint, **self._serialize_json(kwargs)) as resp:
+            await raise_for_status(resp)
+            return load_json(await resp.read())
 
     async def put(self, endpoint: str, **kwargs) -> dict:
-        async with self.session.put(self._url_for(endpoint), **kwargs) as resp:
-            await self.raise_for_status(resp)
-            return await resp.json()
+        async with self.session.put(self.base_api_url + endpoint, **self._serialize_json(kwargs)) as resp:
+            await raise_for_status(resp)
+            return load_json(await resp.read())
+
+    async def head(self, endpoint: str, **kwargs) -> int:
+        """Returns just the response status, no body is downloaded."""
+        async with self.session.head(self.base_api_url + endpoint, **kwargs) as resp:
+            return resp.status
 
     async def delete(self, endpoint: str, **kwargs) -> Optional[dict]:
-        async with self.session.delete(self._url_for(endpoint), **kwargs) as resp:
+        async with self.session.delete(self.base_api_url + endpoint, **self._serialize_json(kwargs)) as resp:
             if resp.status == 204:
                 return
 
-            await self.raise_for_status(resp)
-            return await resp.json()
+            await raise_for_status(resp)
+            return load_json(await resp.read())
 
 
 class GithubAPI(BaseAPIClient):
@@ -97,7 +156,7 @@ class GithubAPI(BaseAPIClient):
                 url=f"{github_repo_stats_endpoint}{repository_name}/commits",
                 params={"sha": "master", "per_page": 1}
         ) as response:
-            await self.raise_for_status(response)
+            await raise_for_status(response)
             last_page = response.links.get("last")
             if last_page:
                 # we can get number of pages from url parameters
@@ -109,12 +168,14 @@ class GithubAPI(BaseAPIClient):
 
 
 class TortoiseAPI(BaseAPIClient):
+    TORTOISE_API_URL = "https://api.tortoisecommunity.org/private/"
+
     def __init__(self, *, loop: AbstractEventLoop):
         auth_header = {
             "Authorization": f"Token {os.getenv('API_ACCESS_TOKEN')}",
             "Content-Type": "application/json"
         }
-        super().__init__("https://api.tortoisecommunity.org/private/", loop=loop, headers=auth_header)
+        super().__init__(self.TORTOISE_API_URL, loop=loop, headers=auth_header)
 
     async def get_suggestions_under_review(self) -> List[dict]:
         # Gets all suggestion that are under-review
@@ -152,7 +213,7 @@ class TortoiseAPI(BaseAPIClient):
 
     async def get_all_rules(self) -> List[dict]:
         # Return is list of dicts in format  ('number', 'name', alias', 'statement'):
-        return await self.get("rules/")
+        return await self.get("rules/", conditional=True)
 
     async def get_server_meta(self, guild_id: int = tortoise_guild_id) -> dict:
         # Return ('event_submission', 'mod_mail', 'bug_report', 'suggestions', 'suggestion_message_id', 'bot_status')
@@ -170,17 +231,51 @@ class TortoiseAPI(BaseAPIClient):
         # Gets all members with all data except email
         return await self.get("members/")
 
+    async def iter_all_members(self, page_size: int = 500) -> AsyncGenerator[dict, None]:
+        """
+        Same data as get_all_members but fetched page by page so caller can stop early.
+        Memory is bounded by page_size only when API paginates members/ with limit/cursor params
+        and returns pages in format {"results": [...], "next": cursor or None}.
+        If API returns the whole list instead (no pagination support) all members are yielded from it.
+        """
+        cursor = None
+        while True:
+            params = {"limit": page_size}
+            if cursor:
+                params["cursor"] = cursor
+
+            page = await self.get("members/", params=params)
+            if isinstance(page, list):
+                for member_data in page:
+                    yield member_data
+                return
+
+            for member_data in page["results"]:
+                yield member_data
+
+            cursor = page.get("next")
+            if not cursor:
+                break
+
     async def get_member_data(self, member_id: int) -> dict:
         # Gets all member data excluding email.
         return await self.get(f"members/{member_id}/")
 
-    async def edit_member_roles(self, member: Member, roles_ids: List[int]):
+    async def edit_member_roles(self, member_id: int, roles_ids: List[int], guild_id: int = tortoise_guild_id):
         payload = {
-            "user_id": member.id,
-            "guild_id": member.guild.id,
+            "user_id": member_id,
+            "guild_id": guild_id,
             "roles": roles_ids
         }
-        await self.put(f"members/{member.id}/", json=payload)
+        await self.put(f"members/{member_id}/", json=payload)
+
+    async def edit_members_roles(self, roles_by_member: Dict[int, List[int]], guild_id: int = tortoise_guild_id):
+        """Saves roles of multiple members in a single request."""
+        payload = [
+            {"user_id": member_id, "guild_id": guild_id, "roles": roles_ids}
+            for member_id, roles_ids in roles_by_member.items()
+        ]
+        await self.put("members/edit/bulk/", json=payload)
 
     async def insert_new_member(self, member: Member):
         """For inserting new members in the database."""
@@ -221,6 +316,26 @@ class TortoiseAPI(BaseAPIClient):
         # Return ('join_date', 'leave_date', 'mod_mail', 'verified', 'member', 'roles')
         return await self.get(f"members/meta/{member_id}/")
 
+    async def member_exists(self, member_id: int) -> bool:
+        """
+        Probes member meta with HEAD so no body is downloaded.
+        Any status other than 200/404 (eg. HEAD not routed, rate limit, server error) falls back to full GET,
+        which raises ResponseCodeError if that fails too.
+        """
+        status = await self.head(f"members/meta/{member_id}/")
+        if status == 200:
+            return True
+        elif status == 404:
+            return False
+
+        try:
+            await self.get_member_meta(member_id)
+        except ResponseCodeError as e:
+            if e.status == 404:
+                return False
+            raise
+        return True
+
     async def get_member_roles(self, member_id: int) -> List[int]:
         member_meta = await self.get_member_meta(member_id)
         return member_meta["roles"]
@@ -243,34 +358,35 @@ class TortoiseAPI(BaseAPIClient):
 
     async def get_member_warnings(self, member_id: int) -> List[dict]:
         """
-        API returns a list of str (which are stringed dicts) so need to deserialize that.
+        Warnings used to be stored as a list of str (which are stringed dicts) while new ones are stored
+        as native JSON objects, so deserialize only the stringed ones.
         Example return from API:
         [
             '{"date": "2020-05-04T21:36:43.045204+00:00",
             "reason": "test",
-            "mod": 197918569894379520}'
+            "mod": 197918569894379520}',
+            {"date": "2020-05-05T10:12:01.000000+00:00", "reason": "test", "mod": 197918569894379520}
         ]
         """
         member_moderation = await self.get_member_moderation(member_id)
         warnings = member_moderation["warnings"]
-        deserialized_warnings = [json.loads(warning) for warning in warnings]
+        deserialized_warnings = [
+            orjson.loads(warning) if isinstance(warning, str) else warning for warning in warnings
+        ]
         return deserialized_warnings
 
     async def get_member_warnings_count(self, member_id: int) -> int:
-        return len(await self.get_member_warnings(member_id))
+        response = await self.get(f"members/moderation/{member_id}/warnings/count/")
+        return response["count"]
 
-    async def add_member_warning(self, mod_id: int, member_id: int, reason: str):
+    async def add_member_warning(self, mod_id: int, member_id: int, reason: str) -> dict:
+        """Appends a single warning server side and returns the created warning."""
         new_warning = {
             "mod": mod_id,
             "reason": reason,
             "date": datetime.now(timezone.utc).isoformat()
         }
-
-        current_warnings = await self.get_member_warnings(member_id)
-        current_warnings.append(new_warning)
-        serialized_warnings = [json.dumps(warning_dict) for warning_dict in current_warnings]
-        warnings_payload = {"warnings": serialized_warnings}
-        await self.put(f"members/moderation/{member_id}/", json=warnings_payload)
+        return await self.post(f"members/moderation/{member_id}/warnings/", json=new_warning)
 
     async def get_projects_data(self):
         return await self.get("projects/")
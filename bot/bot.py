@@ -20,8 +20,8 @@ console_logger = logging.getLogger("console")
 
 class Bot(commands.Bot):
     # If not empty then only these will be loaded. Good for local debugging. If empty all found are loaded.
-    allowed_extensions = ()
-    banned_extensions = ("advent_of_code",)
+    allowed_extensions = frozenset()
+    banned_extensions = frozenset(("advent_of_code",))
 
     def __init__(self, prefix="t.", *args, **kwargs):
         super(Bot, self).__init__(*args, command_prefix=prefix, intents=discord.Intents.all(), **kwargs)
@@ -63,9 +63,8 @@ class Bot(commands.Bot):
         self.tortoise_meta_cache = await self.api_client.get_server_meta()
 
     def load_extensions(self):
-        for extension_path in Path("bot/cogs").glob("*.py"):
-            extension_name = extension_path.stem
-
+        extension_names = [path.stem for path in Path("bot/cogs").iterdir() if path.suffix == ".py"]
+        for extension_name in extension_names:
             if extension_name in self.banned_extensions:
                 continue
             elif self.allowed_extensions and extension_name not in self.allowed_extensions:
@@ -76,9 +75,17 @@ class Bot(commands.Bot):
             try:
                 self.load_extension(dotted_path)
                 console_logger.info(f"loaded {dotted_path}")
-            except Exception as e:
-                traceback_msg = traceback.format_exception(etype=type(e), value=e, tb=e.__traceback__)
-                console_logger.info(f"Failed to load cog {dotted_path} - traceback:{traceback_msg}")
+            except Exception:
+                console_logger.exception("Failed to load cog %s", dotted_path)
+
+    async def close(self):
+        # Save queued member role updates while the API session is still open, then unload cogs and close it
+        tortoise_server = self.get_cog("TortoiseServer")
+        if tortoise_server is not None:
+            await tortoise_server.save_pending_role_updates()
+
+        await super().close()
+        await self.api_client.close()
 
     @staticmethod
     async def on_connect():
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import datetime
 from types import SimpleNamespace
@@ -17,11 +18,20 @@ from bot.utils.embed_handler import success, failure, welcome, footer_embed, inf
 
 logger = logging.getLogger(__name__)
 
+# Hoisted for the on_message hot path which runs for every message the bot sees
+_TORTOISE_GUILD_ID = constants.tortoise_guild_id
+_SUGGESTIONS_CHANNEL_ID = constants.suggestions_channel_id
+
+# Seconds between batched member role database updates, and the most it backs off to if API keeps failing
+ROLE_UPDATES_FLUSH_INTERVAL = 0.5
+ROLE_UPDATES_MAX_BACKOFF = 300
+
 
 class TortoiseServer(commands.Cog):
     """These commands will only work in the tortoise discord server."""
     def __init__(self, bot):
         self.bot = bot
+        self._bot_user_id = bot.user.id
         self.tortoise_guild = bot.get_guild(constants.tortoise_guild_id)
         self.verified_role = self.tortoise_guild.get_role(constants.verified_role_id)
         self.new_member_role = self.tortoise_guild.get_role(constants.new_member_role)
@@ -31,10 +41,20 @@ class TortoiseServer(commands.Cog):
         self.announcements_channel = bot.get_channel(constants.announcements_channel_id)
         self.code_submissions_channel = bot.get_channel(constants.code_submissions_channel_id)
 
-        self._database_role_update_lock = False
+        # Members whose roles are currently being restored, their role updates are not saved to database meanwhile
+        self._role_update_inflight = set()
+        # Member id to latest roles ids, saved to database in batches by flush_role_updates
+        self._pending_role_updates = {}
         self._rules = None
+        # Rules keyed by both their number and lowercased aliases
+        self._rule_index = {}
+        self._rules_embed_body = ""
+        self._last_member_count = None
+        self._emoji_to_role = {}
+        self._build_assignable_roles_cache()
         self.update_member_count_channel.start()
         self.remove_new_member_role.start()
+        self.flush_role_updates.start()
         self.bot.loop.create_task(self.refresh_rules_helper())
         self.SUGGESTION_MESSAGE_CONTENT = "React to this message to add new suggestion"
 
@@ -53,29 +73,28 @@ class TortoiseServer(commands.Cog):
     @commands.Cog.listener()
     @commands.check(check_if_it_is_tortoise_guild)
     async def on_message(self, message):
-        if message.guild is None:
-            return
-        elif message.guild.id != constants.tortoise_guild_id:
+        # Only the suggestion channel is handled so check it first, it filters out almost all messages
+        guild = message.guild
+        if message.channel.id != _SUGGESTIONS_CHANNEL_ID or guild is None or guild.id != _TORTOISE_GUILD_ID:
             return
 
         # Suggestion message handler
-        if message.channel.id == constants.suggestions_channel_id:
-            if (
-                message.author == self.bot.user and
-                message.embeds and
-                message.embeds[0].description == self.SUGGESTION_MESSAGE_CONTENT
-            ):
-                await self.bot.api_client.edit_suggestion_message_id(message.id)
+        if (
+            message.author == self.bot.user and
+            message.embeds and
+            message.embeds[0].description == self.SUGGESTION_MESSAGE_CONTENT
+        ):
+            await self.bot.api_client.edit_suggestion_message_id(message.id)
+        else:
+            old_suggestion_msg_id = await self.bot.api_client.get_suggestion_message_id()
+            try:
+                old_message = await message.channel.fetch_message(old_suggestion_msg_id)
+            except discord.NotFound:
+                pass
             else:
-                old_suggestion_msg_id = await self.bot.api_client.get_suggestion_message_id()
-                try:
-                    old_message = await message.channel.fetch_message(old_suggestion_msg_id)
-                except discord.NotFound:
-                    pass
-                else:
-                    await old_message.delete()
+                await old_message.delete()
 
-                await self.create_new_suggestion_message()
+            await self.create_new_suggestion_message()
 
     async def refresh_rules_helper(self):
         try:
@@ -84,11 +103,100 @@ class TortoiseServer(commands.Cog):
             msg = f"Failed to fetch rules from API:{e}"
             logger.critical(msg)
             await self.bot.log_error(msg)
+        else:
+            self._cache_rules()
+
+    def _cache_rules(self):
+        rule_index = {}
+        for rule_dict in self._rules:
+            rule_index[rule_dict["number"]] = rule_dict
+            for alias in rule_dict["alias"]:
+                rule_index[alias.lower()] = rule_dict
+
+        self._rule_index = rule_index
+        self._rules_embed_body = "\n\n".join(
+            f"**{rule_dict['number']}. {rule_dict['name']}**\n"
+            f"{rule_dict['statement']}\n"
+            f"[**aliases: **{', '.join(rule_dict['alias'])}]"
+            for rule_dict in self._rules
+        )
 
     @tasks.loop(hours=6)
     async def update_member_count_channel(self):
-        guild = self.member_count_channel.guild
-        await self.member_count_channel.edit(name=f"Member count {len(guild.members)}")
+        member_count = self.member_count_channel.guild.member_count
+        if member_count == self._last_member_count:
+            return
+
+        try:
+            await self.member_count_channel.edit(name=f"Member count {member_count}")
+        except HTTPException as e:
+            logger.warning("Failed to update member count channel: %s", e)
+        else:
+            self._last_member_count = member_count
+
+    @tasks.loop(seconds=ROLE_UPDATES_FLUSH_INTERVAL)
+    async def flush_role_updates(self):
+        await self.save_pending_role_updates()
+
+    async def save_pending_role_updates(self):
+        if not self._pending_role_updates:
+            return
+
+        pending, self._pending_role_updates = self._pending_role_updates, {}
+        try:
+            await self.bot.api_client.edit_members_roles(pending)
+        except ResponseCodeError as e:
+            if 400 <= e.status < 500:
+                # Either bulk endpoint is not available or some entry is invalid, save them one by one so only
+                # the invalid ones are lost.
+                logger.warning("API rejected bulk roles update (%s), saving %s members one by one", e, len(pending))
+                await self._save_role_updates_individually(pending)
+            else:
+                self._role_updates_failed(pending, e)
+        except Exception as e:
+            self._role_updates_failed(pending, e)
+        else:
+            self._reset_role_updates_interval()
+
+    async def _save_role_updates_individually(self, pending: dict):
+        failed = {}
+        error = None
+        for member_id, roles_ids in pending.items():
+            try:
+                await self.bot.api_client.edit_member_roles(member_id, roles_ids)
+            except ResponseCodeError as e:
+                if 400 <= e.status < 500:
+                    logger.error("API rejected roles of member %s, discarding them: %s", member_id, e)
+                else:
+                    failed[member_id], error = roles_ids, e
+            except Exception as e:
+                failed[member_id], error = roles_ids, e
+
+        if failed:
+            self._role_updates_failed(failed, error)
+        else:
+            self._reset_role_updates_interval()
+
+    def _reset_role_updates_interval(self):
+        if self.flush_role_updates.seconds != ROLE_UPDATES_FLUSH_INTERVAL:
+            self.flush_role_updates.change_interval(seconds=ROLE_UPDATES_FLUSH_INTERVAL)
+
+    def _role_updates_failed(self, pending: dict, error: Exception):
+        # Back off exponentially so an API outage doesn't get hammered twice a second
+        retry_after = min(self.flush_role_updates.seconds * 2, ROLE_UPDATES_MAX_BACKOFF)
+        logger.warning(
+            "Failed to save roles of %s members to database, retrying in %ss: %s", len(pending), retry_after, error
+        )
+        self.flush_role_updates.change_interval(seconds=retry_after)
+        # Re-queue for next flush unless newer roles for that member were queued meanwhile
+        for member_id, roles_ids in pending.items():
+            self._pending_role_updates.setdefault(member_id, roles_ids)
+
+    def cog_unload(self):
+        # On shutdown Bot.close already saved pending updates before closing, this covers only reloading the cog
+        self.flush_role_updates.cancel()
+        if self._pending_role_updates:
+            self.bot.loop.create_task(self.save_pending_role_updates())
 
     @tasks.loop(hours=24)
     async def remove_new_member_role(self):
@@ -102,7 +210,7 @@ class TortoiseServer(commands.Cog):
                 try:
                     await member.remove_roles(self.new_member_role)
                 except HTTPException:
-                    logger.warning(f"Bot could't remove new member role from {member} {member.id}")
+                    logger.warning("Bot could't remove new member role from %s %s", member, member.id)
 
     @commands.command(enabled=False)
     @commands.check(check_if_it_is_tortoise_guild)
@@ -118,26 +226,14 @@ class TortoiseServer(commands.Cog):
     @commands.check(check_if_it_is_tortoise_guild)
     async def rule(self, ctx, alias: Union[int, str]):
         """Shows rule based on number order or alias."""
-        if isinstance(alias, int):
-            rule_dict = self._get_rule_by_value(alias)
-        else:
-            rule_dict = self._get_rule_by_alias(alias)
+        key = alias.lower() if isinstance(alias, str) else alias
+        rule_dict = self._rule_index.get(key)
 
         if rule_dict is None:
             await ctx.send(embed=failure("No such rule."), delete_after=5)
         else:
             await ctx.send(embed=info(rule_dict["statement"], ctx.guild.me, f"Rule: {rule_dict['name']}"))
 
-    def _get_rule_by_value(self, number: int) -> Union[dict, None]:
-        for rule_dict in self._rules:
-            if rule_dict["number"] == number:
-                return rule_dict
-
-    def _get_rule_by_alias(self, alias: str) -> Union[dict, None]:
-        for rule_dict in self._rules:
-            if alias.lower() in rule_dict["alias"]:
-                return rule_dict
-
     @commands.command()
     @commands.check(check_if_it_is_tortoise_guild)
     async def rules(self, ctx):
@@ -162,25 +258,14 @@ class TortoiseServer(commands.Cog):
         await channel.send(embed=rules_embed)
 
     def _get_rules_embed(self, guild: discord.Guild) -> discord.Embed:
-        embed_body = []
-        for rule_dict in self._rules:
-            rule_entry = (
-                f"**{rule_dict['number']}. {rule_dict['name']}**\n"
-                f"{rule_dict['statement']}\n"
-                f"[**aliases: **{', '.join(rule_dict['alias'])}]"
-            )
-            embed_body.append(rule_entry)
-
-        rules_embed = info("\n\n".join(embed_body), guild.me, f"{guild.name} Rules")
+        rules_embed = info(self._rules_embed_body, guild.me, f"{guild.name} Rules")
         rules_embed.set_footer(text="Tortoise Community")
         rules_embed.set_thumbnail(url=guild.icon_url)
         return rules_embed
 
     async def _new_member_register_in_database(self, member: discord.Member):
-        logger.info(f"New member {member} does not exist in database, adding now.")
+        logger.info("New member %s does not exist in database, adding now.", member)
         await self.bot.api_client.insert_new_member(member)
-        await member.add_roles(self.new_member_role)
-        await self.log_channel.send(embed=welcome(f"{member} has joined the Tortoise Community."))
         dm_msg = (
             "Welcome to Tortoise Community!\n\n"
             f"By joining the server you agree to our [rules]({constants.rules_url}).\n"
@@ -188,19 +273,37 @@ class TortoiseServer(commands.Cog):
             f"add roles to yourself from <#{constants.react_for_roles_channel_id}>\n\n"
             f"We hope you enjoy your stay!"
         )
-        await member.send(embed=footer_embed(dm_msg, "Welcome"))
+        # Member is in database now, rest of the calls are independent of each other
+        results = await asyncio.gather(
+            member.add_roles(self.new_member_role),
+            self.log_channel.send(embed=welcome(f"{member} has joined the Tortoise Community.")),
+            member.send(embed=footer_embed(dm_msg, "Welcome")),
+            return_exceptions=True
+        )
+        self._log_gather_exceptions(results, f"registering new member {member}")
 
     async def _member_re_joined(self, member: discord.Member):
-        logger.info(f"Member {member} re-joined and is verified in database, adding previous roles..")
+        logger.info("Member %s re-joined and is verified in database, adding previous roles..", member)
         previous_roles = await self.bot.api_client.get_member_roles(member.id)
-        await self.add_verified_roles_to_member(member, previous_roles)
-        await self.bot.api_client.member_rejoined(member)
-        await self.log_channel.send(embed=welcome(f"{member} has returned to Tortoise Community."))
         msg = (
             "Welcome back to Tortoise Community!\n\n"
             "The roles you had last time will be restored and added back to you.\n"
         )
-        await member.send(embed=footer_embed(msg, "Welcome"))
+        results = await asyncio.gather(
+            self.add_verified_roles_to_member(member, previous_roles),
+            self.bot.api_client.member_rejoined(member),
+            self.log_channel.send(embed=welcome(f"{member} has returned to Tortoise Community.")),
+            member.send(embed=footer_embed(msg, "Welcome")),
+            return_exceptions=True
+        )
+        self._log_gather_exceptions(results, f"re-joining member {member}")
+
+    @staticmethod
+    def _log_gather_exceptions(results: Iterable, action: str):
+        # One failure (eg. member has DMs disabled) should not abort the rest so they are only logged
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning("Failed step while %s: %r", action, result)
 
     @commands.Cog.listener()
     @commands.check(check_if_it_is_tortoise_guild)
@@ -210,50 +313,65 @@ class TortoiseServer(commands.Cog):
         """
         if before.pending is True and after.pending is False:
 
-            logger.info(f"New member verified from discord {after}")
-            try:
-                member_meta = await self.bot.api_client.get_member_meta(after.id)
-            except ResponseCodeError:
+            logger.info("New member verified from discord %s", after)
+            # Cheap HEAD probe first, most members verifying are new so the full meta is usually not needed
+            if not await self.bot.api_client.member_exists(after.id):
                 await self._new_member_register_in_database(after)
             else:
-                if member_meta["leave_date"] is None and member_meta["verified"]:
-                    # Could be put to use for new website
-                    pass
+                try:
+                    member_meta = await self.bot.api_client.get_member_meta(after.id)
+                except ResponseCodeError:
+                    await self._new_member_register_in_database(after)
                 else:
-                    await self._member_re_joined(after)
+                    if member_meta["leave_date"] is None and member_meta["verified"]:
+                        # Could be put to use for new website
+                        pass
+                    else:
+                        await self._member_re_joined(after)
 
-        if before.roles == after.roles or self._database_role_update_lock:
+        if before.roles == after.roles or after.id in self._role_update_inflight:
             return
 
         roles_ids = [role.id for role in after.roles]
-        logger.debug(f"Roles from member {after} changed, changing database field to: {roles_ids}")
-        await self.bot.api_client.edit_member_roles(after, roles_ids)
+        logger.debug("Roles from member %s changed, queueing database field change to: %s", after, roles_ids)
+        self._pending_role_updates[after.id] = roles_ids
 
     async def add_verified_roles_to_member(self, member: discord.Member, additional_roles: Iterable[int] = tuple()):
-        self._database_role_update_lock = True
         # In case additional_roles are fetched from database, they can be no longer existing due to not removing roles
-        # that got deleted, so just catch Exception and ignore.
+        # that got deleted, so just filter out the ones not found.
+        # Database also saves roles the bot can't assign (@everyone, managed ones like booster or integration roles and
+        # ones above bot top role), any of those would make Discord reject the whole edit request so skip them.
+        bot_top_role = self.tortoise_guild.me.top_role
         roles = [self.tortoise_guild.get_role(role_id) for role_id in additional_roles]
-        roles.append(self.verified_role)
-
-        for role in roles:
+        roles = [
+            role for role in roles
+            if role is not None and not role.is_default() and not role.managed and role < bot_top_role
+        ]
+        if self.verified_role not in roles:
+            roles.append(self.verified_role)
+
+        self._role_update_inflight.add(member.id)
+        try:
+            # Non atomic add_roles sends all roles in a single member edit request, atomic one does a request per role
+            await member.add_roles(*roles, atomic=False)
+        except HTTPException as e:
+            logger.warning("Failed to add roles %s to %s, adding only verified role: %s", roles, member, e)
             try:
-                await member.add_roles(role)
-            except HTTPException:
-                continue
-
-        self._database_role_update_lock = False
+                await member.add_roles(self.verified_role)
+            except HTTPException as e:
+                logger.warning("Failed to add verified role to %s: %s", member, e)
+        finally:
+            self._role_update_inflight.discard(member.id)
 
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload):
         if payload.channel_id == constants.react_for_roles_channel_id:
-            guild = self.bot.get_guild(payload.guild_id)
-            member = guild.get_member(payload.user_id)
-            role = self.get_assignable_role(payload, guild)
-
-            if member.id == self.bot.user.id:
+            if payload.user_id == self._bot_user_id:
                 return  # Ignore the bot
-            elif role is not None:
+
+            role = self.get_assignable_role(payload)
+            if role is not None:
+                member = self.bot.get_guild(payload.guild_id).get_member(payload.user_id)
                 await member.add_roles(role)
                 embed = success(f"`{role.name}` has been assigned to you in the Tortoise community.")
                 await member.send(embed=embed, delete_after=10)
@@ -264,27 +382,40 @@ class TortoiseServer(commands.Cog):
 
     @commands.Cog.listener()
     async def on_raw_reaction_remove(self, payload):
-        if payload.channel_id == constants.react_for_roles_channel_id:
-            guild = self.bot.get_guild(payload.guild_id)
-            member = guild.get_member(payload.user_id)
-            role = self.get_assignable_role(payload, guild)
-
-            if role is not None:
-                await member.remove_roles(role)
+        if payload.channel_id != constants.react_for_roles_channel_id or payload.user_id == self._bot_user_id:
+            return
 
-    @classmethod
-    def get_assignable_role(cls, payload, guild):
-        role_id = constants.self_assignable_roles.get(payload.emoji.id)
-        if role_id is not None:
-            role = guild.get_role(role_id)
+        role = self.get_assignable_role(payload)
+        if role is not None:
+            member = self.bot.get_guild(payload.guild_id).get_member(payload.user_id)
+            await member.remove_roles(role)
 
+    def _build_assignable_roles_cache(self):
+        emoji_to_role = {}
+        for emoji_id, role_id in constants.self_assignable_roles.items():
+            role = self.tortoise_guild.get_role(role_id)
             if role is not None:
-                return role
+                emoji_to_role[emoji_id] = role
             else:
-                logger.critical(f"Emoji id found in dictionary but role id {role_id} not found in guild!")
+                logger.critical("Emoji id %s found in dictionary but role id %s not found in guild!", emoji_id, role_id)
 
-        else:
-            logger.critical(f"No mapping for emoji {payload.emoji.id} in self_assignable_roles!")
+        self._emoji_to_role = emoji_to_role
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        if after.guild.id == constants.tortoise_guild_id:
+            self._build_assignable_roles_cache()
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        if role.guild.id == constants.tortoise_guild_id:
+            self._build_assignable_roles_cache()
+
+    def get_assignable_role(self, payload):
+        role = self._emoji_to_role.get(payload.emoji.id)
+        if role is None:
+            logger.critical("No assignable role for emoji %s in self_assignable_roles!", payload.emoji.id)
+        return role
 
     @commands.command()
     @commands.check(check_if_it_is_tortoise_guild)
@@ -1,27 +1,96 @@
 """
-Non blocking logging file handler by using threads.
+Non blocking logging file handler by buffering records in memory and flushing them in batches.
 """
 
-from threading import Thread
-from logging import FileHandler
+import os
+import sys
+import atexit
+import logging
+import traceback
+from io import BufferedWriter, FileIO
+from threading import Lock, Timer
 
-from queue import Queue
 
+class NonBlockingFileHandler(logging.Handler):
+    BUFFER_SIZE = 64 * 1024
+    FLUSH_INTERVAL = 30
 
-class NonBlockingFileHandler(FileHandler):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._queue = Queue(maxsize=9999)
-        self._thread = Thread(target=self.__loop, daemon=True)
-        self._thread.start()
+    def __init__(self, filename: str, encoding: str = "utf-8", level: int = logging.NOTSET):
+        super().__init__(level)
+        self.encoding = encoding
+        fd = os.open(os.path.abspath(filename), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._stream = BufferedWriter(FileIO(fd, mode="ab"), buffer_size=self.BUFFER_SIZE)
+        self._buffer = bytearray()
+        self._buffer_lock = Lock()
+        self._timer = None
+        self._closed = False
+        self._schedule_flush()
+        atexit.register(self.close)
 
-    def emit(self, record):
-        self._queue.put(record)
+    def emit(self, record: logging.LogRecord):
+        try:
+            data = (self.format(record) + "\n").encode(self.encoding)
+        except Exception:
+            self.handleError(record)
+            return
+
+        with self._buffer_lock:
+            if self._closed:
+                return
+
+            self._buffer += data
+            # Errors are flushed right away so crash context isn't lost
+            if len(self._buffer) >= self.BUFFER_SIZE or record.levelno >= logging.ERROR:
+                self._flush_locked()
+
+    def flush(self):
+        with self._buffer_lock:
+            if not self._closed:
+                self._flush_locked()
+
+    def close(self):
+        with self._buffer_lock:
+            if self._closed:
+                return
+
+            self._closed = True
+            if self._timer is not None:
+                self._timer.cancel()
 
-    def __loop(self):
-        while True:
-            record = self._queue.get()
             try:
-                super().emit(record)
-            except Exception as e:
-                print("Async handler exception:", e)
+                self._flush_locked()
+            finally:
+                self._stream.close()
+
+        atexit.unregister(self.close)
+        super().close()
+
+    def _flush_locked(self):
+        """Write the whole buffer in one go. Caller has to hold the buffer lock."""
+        if not self._buffer:
+            return
+
+        try:
+            self._stream.write(self._buffer)
+            self._stream.flush()
+        except Exception:
+            # Same reporting as logging.Handler.handleError, there is no single record to pass to it here
+            if logging.raiseExceptions and sys.stderr:
+                sys.stderr.write(
+                    f"--- Logging error ---\nFailed to write {len(self._buffer)} bytes of buffered log records, "
+                    "they are dropped.\n"
+                )
+                traceback.print_exc(file=sys.stderr)
+        finally:
+            self._buffer.clear()
+
+    def _schedule_flush(self):
+        self._timer = Timer(self.FLUSH_INTERVAL, self._periodic_flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _periodic_flush(self):
+        self.flush()
+        with self._buffer_lock:
+            if not self._closed:
+                self._schedule_flush()